@@ -1498,7 +1498,7 @@ async function getOpenAIResponse(userMessage) {
 
 async function getLocalRAGResponse(userMessage) {
     /**
-     * Calls the local RAG server (Mistral-7B + FAISS).
+     * Calls the local RAG server (Mistral-7B + local vector search).
      * Server must be running: python scripts/local_rag_server.py
      */
     try {
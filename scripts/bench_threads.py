@@ -4,7 +4,8 @@ Benchmark script to find optimal thread count for your CPU.
 Usage:
     python scripts/bench_threads.py [--model path/to/model.gguf]
 
-This will test inference with 4, 6, 8, 10, 12 threads and report latencies.
+This will test inference with thread counts around your physical core count
+(half, N-1, N, N+2; capped at the logical count) and report latencies.
 Pick the thread count with the lowest average latency.
 """
 
@@ -12,41 +13,31 @@ import os
 import sys
 import time
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-# Parse args first
-parser = argparse.ArgumentParser(description="Benchmark LLM inference with different thread counts")
-parser.add_argument("--model", type=str, default=None, help="Path to GGUF model")
-parser.add_argument("--runs", type=int, default=3, help="Number of runs per thread count")
-args = parser.parse_args()
+from cpu_topology import available_cpus, physical_cores
 
-# Find model
 BASE_DIR = Path(__file__).parent.parent
 MODEL_DIR = BASE_DIR / "models"
 DEFAULT_MODEL = "mistral-7b-instruct-v0.2.Q4_K_M.gguf"
 
-model_path = args.model or (MODEL_DIR / DEFAULT_MODEL)
-if not Path(model_path).exists():
-    print(f"ERROR: Model not found at {model_path}")
-    print("Please download the model first. See README.local-rag.md")
-    sys.exit(1)
+# Test prompt (llama-cpp-python prepends BOS itself)
+PROMPT = """[INST] You are a helpful assistant. Explain in 2-3 sentences how DeFi lending pools work and what is a health factor. [/INST]"""
 
-print("=" * 60)
-print("LLM Thread Benchmark")
-print("=" * 60)
-print(f"Model: {model_path}")
-print(f"Runs per config: {args.runs}")
-print("=" * 60)
-
-# Test prompt
-PROMPT = """<s>[INST] You are a helpful assistant. Explain in 2-3 sentences how DeFi lending pools work and what is a health factor. [/INST]"""
-
-def benchmark(n_threads: int, runs: int = 3):
-    """Run benchmark with specified thread count."""
+def benchmark(model_path: str, n_threads: int, runs: int = 3):
+    """Run benchmark with specified thread count.
+    
+    Called in a fresh child process per thread count (see run_isolated), so the
+    env vars below are set before llama_cpp is first imported and the model's
+    memory is returned to the OS when the process exits.
+    """
     # Set env vars before importing
     os.environ["OMP_NUM_THREADS"] = str(n_threads)
     os.environ["MKL_NUM_THREADS"] = str(n_threads)
     os.environ["OPENBLAS_NUM_THREADS"] = str(n_threads)
+    os.environ["GGML_N_THREADS"] = str(n_threads)
     
     from llama_cpp import Llama
     
@@ -58,6 +49,7 @@ def benchmark(n_threads: int, runs: int = 3):
         model_path=str(model_path),
         n_ctx=2048,
         n_threads=n_threads,
+        n_threads_batch=n_threads,
         n_gpu_layers=0,
         verbose=False
     )
@@ -89,7 +81,6 @@ def benchmark(n_threads: int, runs: int = 3):
     
     print(f"  AVERAGE: {avg_time:.2f}s, {avg_speed:.1f} tok/s")
     
-    # Cleanup to free memory
     del llm
     
     return {
@@ -100,34 +91,67 @@ def benchmark(n_threads: int, runs: int = 3):
         "avg_speed": avg_speed
     }
 
-# Run benchmarks
-results = []
-thread_counts = [4, 6, 8, 10, 12]
-
-print("\nStarting benchmark (this may take a few minutes)...")
+def run_isolated(model_path: str, n_threads: int, runs: int):
+    """Run benchmark() in its own process and return its result."""
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+        return pool.submit(benchmark, model_path, n_threads, runs).result()
 
-for n in thread_counts:
-    try:
-        result = benchmark(n, args.runs)
-        results.append(result)
-    except Exception as e:
-        print(f"  ERROR with {n} threads: {e}")
-
-# Summary
-print("\n" + "=" * 60)
-print("SUMMARY")
-print("=" * 60)
-print(f"{'Threads':<10} {'Avg Time':<12} {'Min Time':<12} {'Avg Speed':<12}")
-print("-" * 46)
-
-best = None
-for r in results:
-    print(f"{r['threads']:<10} {r['avg_time']:<12.2f} {r['min_time']:<12.2f} {r['avg_speed']:<12.1f}")
-    if best is None or r['avg_time'] < best['avg_time']:
-        best = r
-
-if best:
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark LLM inference with different thread counts")
+    parser.add_argument("--model", type=str, default=None, help="Path to GGUF model")
+    parser.add_argument("--runs", type=int, default=3, help="Number of runs per thread count")
+    args = parser.parse_args()
+    
+    # Find model
+    model_path = str(args.model or (MODEL_DIR / DEFAULT_MODEL))
+    if not Path(model_path).exists():
+        print(f"ERROR: Model not found at {model_path}")
+        print("Please download the model first. See README.local-rag.md")
+        sys.exit(1)
+    
+    print("=" * 60)
+    print("LLM Thread Benchmark")
+    print("=" * 60)
+    print(f"Model: {model_path}")
+    print(f"Runs per config: {args.runs}")
+    print("=" * 60)
+    
+    # Run benchmarks
+    results = []
+    phys = physical_cores()
+    logical = available_cpus()
+    thread_counts = sorted({n for n in (max(1, phys // 2), phys - 1, phys, phys + 2) if 1 <= n <= logical})
+    print(f"Physical cores: {phys}, logical CPUs: {logical}")
+    print(f"Thread counts: {thread_counts}")
+    
+    print("\nStarting benchmark (this may take a few minutes)...")
+    
+    for n in thread_counts:
+        try:
+            result = run_isolated(model_path, n, args.runs)
+            results.append(result)
+        except Exception as e:
+            print(f"  ERROR with {n} threads: {e}")
+    
+    # Summary
+    print("\n" + "=" * 60)
+    print("SUMMARY")
+    print("=" * 60)
+    print(f"{'Threads':<10} {'Avg Time':<12} {'Min Time':<12} {'Avg Speed':<12}")
     print("-" * 46)
-    print(f"\n✓ RECOMMENDED: --threads {best['threads']} (fastest average: {best['avg_time']:.2f}s)")
-    print(f"\nUse this in your server:")
-    print(f"  python scripts/local_rag_server.py --threads {best['threads']}")
+    
+    best = None
+    for r in results:
+        print(f"{r['threads']:<10} {r['avg_time']:<12.2f} {r['min_time']:<12.2f} {r['avg_speed']:<12.1f}")
+        if best is None or r['avg_time'] < best['avg_time']:
+            best = r
+    
+    if best:
+        print("-" * 46)
+        print(f"\n✓ RECOMMENDED: --threads {best['threads']} (fastest average: {best['avg_time']:.2f}s)")
+        print(f"\nUse this in your server:")
+        print(f"  python scripts/local_rag_server.py --threads {best['threads']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+"""
+CPU topology helpers shared by the local RAG server and the thread benchmark.
+
+Kept import-safe (no argument parsing or heavy imports) so both scripts pick
+the same default thread count.
+"""
+
+import os
+
+
+def available_cpus() -> int:
+    """Logical CPUs this process may run on (respects affinity/cpusets where supported)."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def physical_cores() -> int:
+    """Number of physical CPU cores (SMT siblings excluded), capped at available_cpus()."""
+    try:
+        import psutil
+        n = psutil.cpu_count(logical=False)
+    except ImportError:
+        n = None
+    # psutil reports the host's cores; a container or taskset may allow fewer
+    avail = available_cpus()
+    return min(n or max(1, avail // 2), avail)
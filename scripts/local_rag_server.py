@@ -1,6 +1,6 @@
 """
 Local RAG (Retrieval-Augmented Generation) Server for Mini-DeFi
-Uses Mistral-7B-Instruct (GGUF quantized) + FAISS + Sentence Transformers
+Uses Mistral-7B-Instruct (GGUF quantized) + Sentence Transformers + numpy vector search
 
 This server provides a local AI assistant that:
 1. Embeds your knowledge base (DeFi docs, platform info)
@@ -8,41 +8,137 @@ This server provides a local AI assistant that:
 3. Generates answers using a local LLM (no API keys needed)
 
 Usage:
-    python scripts/local_rag_server.py [--port 5000] [--threads 8]
+    python scripts/local_rag_server.py [--port 5000] [--threads N]
 """
 
 import os
 import sys
 import json
+import time
+import pickle
+import queue
+import re
+import hmac
+import hashlib
 import argparse
+import functools
+import importlib.util
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
 from pathlib import Path
 
+from cpu_topology import physical_cores
+
+MAX_THREADS = 16
+
 # Set thread count early (before importing numpy/torch)
-def set_threads(n):
+def set_threads(n=None, pcore_only=False):
+    # llama.cpp is memory-bandwidth bound; SMT siblings only add contention,
+    # so default to one thread per physical core (P-cores only with --pcore-only).
+    if n is None:
+        cores = physical_core_cpus(True) if pcore_only and hasattr(os, "sched_getaffinity") else None
+        n = min(len(cores) if cores else physical_cores(), MAX_THREADS)
     os.environ["OMP_NUM_THREADS"] = str(n)
-    os.environ["MKL_NUM_THREADS"] = str(n)
-    os.environ["OPENBLAS_NUM_THREADS"] = str(n)
     os.environ["NUMEXPR_NUM_THREADS"] = str(n)
+    os.environ["GGML_N_THREADS"] = str(n)
+    return n
+
+def parse_cpu_list(text: str) -> list:
+    """Parse a Linux CPU list such as "0-3,8,10-11"."""
+    cpus = []
+    for part in text.strip().split(","):
+        if "-" in part:
+            lo, hi = part.split("-")
+            cpus.extend(range(int(lo), int(hi) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+@functools.lru_cache(maxsize=None)
+def physical_core_cpus(pcore_only: bool = False) -> tuple:
+    """One logical CPU id per physical core (Linux sysfs), optionally P-cores only."""
+    allowed = os.sched_getaffinity(0)
+    if pcore_only:
+        # Hybrid Intel CPUs list their performance cores here
+        pcores = Path("/sys/devices/cpu_core/cpus")
+        if pcores.exists():
+            allowed &= set(parse_cpu_list(pcores.read_text()))
+        else:
+            print("[RAG] Warning: --pcore-only ignored (no /sys/devices/cpu_core/cpus)")
+    
+    cores = set()
+    for cpu in allowed:
+        siblings = Path(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list")
+        try:
+            cores.add(min(set(parse_cpu_list(siblings.read_text())) & allowed))
+        except (OSError, ValueError):
+            cores.add(cpu)
+    return tuple(sorted(cores))
+
+def pin_threads(n: int, pcore_only: bool = False):
+    """Pin the process to n physical cores so llama.cpp threads stay off SMT siblings/E-cores."""
+    if not hasattr(os, "sched_setaffinity"):
+        print("[RAG] Warning: CPU pinning is only supported on Linux; not pinning.")
+        return
+    cpus = physical_core_cpus(pcore_only)
+    if len(cpus) < n:
+        # More threads than (performance) cores; leave scheduling to the OS
+        kind = "performance" if pcore_only else "physical"
+        print(f"[RAG] Warning: {n} threads but only {len(cpus)} {kind} cores available; not pinning.")
+        return
+    os.sched_setaffinity(0, set(cpus[:n]))
+    print(f"[RAG] Pinned to CPUs {list(cpus[:n])}")
 
 # Parse args early for thread setting
 parser = argparse.ArgumentParser(description="Local RAG Server for Mini-DeFi")
 parser.add_argument("--port", type=int, default=5000, help="Server port (default: 5000)")
-parser.add_argument("--threads", type=int, default=8, help="CPU threads for inference (default: 8)")
+parser.add_argument("--threads", type=int, default=None, help="CPU threads for inference (default: physical cores, or P-cores with --pcore-only; max 16)")
 parser.add_argument("--model", type=str, default=None, help="Path to GGUF model file")
+parser.add_argument("--embed-device", choices=["auto", "cpu", "cuda", "mps"], default="auto",
+                    help="Device for the embedding model (default: auto; the LLM always runs on CPU)")
+parser.add_argument("--embed-threads", type=int, default=1,
+                    help="CPU threads for query embedding and vector search (default: 1, leaving the cores to the LLM)")
+parser.add_argument("--pcore-only", action="store_true",
+                    help="On hybrid Intel CPUs, pin inference threads to performance cores only (Linux)")
+parser.add_argument("--no-pin", action="store_true", help="Do not pin the process to physical cores")
+parser.add_argument("--numba-search", action="store_true",
+                    help="Use a Numba-compiled retrieval kernel instead of the numpy/BLAS matmul (needs numba)")
+parser.add_argument("--prompt-cache-mb", type=int, default=0,
+                    help="RAM for saved LLM prompt states (default: 0 = off; llama.cpp still reuses the shared prefix in-context)")
+parser.add_argument("--admin-token", type=str, default=None,
+                    help="Token required (X-Admin-Token header) by POST /cache/clear; defaults to $RAG_ADMIN_TOKEN")
+parser.add_argument("--no-cache", action="store_true", help="Disable the retrieval, response and prompt-state caches")
 args = parser.parse_args()
 
-set_threads(args.threads)
+args.threads = set_threads(args.threads, args.pcore_only)
+# numpy's BLAS only serves retrieval (search()); keep it off the LLM's cores
+os.environ["OPENBLAS_NUM_THREADS"] = str(args.embed_threads)
+os.environ["MKL_NUM_THREADS"] = str(args.embed_threads)
+if not args.no_pin:
+    pin_threads(args.threads, args.pcore_only)
 
 import numpy as np
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 
+njit = None
+if args.numba_search:
+    try:
+        from numba import njit
+    except ImportError:
+        print("[RAG] Warning: --numba-search needs numba (pip install numba); using numpy search.")
+
 # Lazy imports for heavy libraries
 llm = None
+prompt_prefix_tokens = []  # PROMPT_PREFIX, tokenized once in init_llm
 embed_model = None
-index = None
+embedding_matrix = None  # (N, d) L2-normalized chunk embeddings, float32
 chunks = []
 chunk_metadata = []
+query_batcher = None
+llm_lock = threading.Lock()  # llama.cpp contexts are not reentrant
+batcher_lock = threading.Lock()
 
 # ============================================================================
 # Configuration
@@ -51,7 +147,22 @@ chunk_metadata = []
 BASE_DIR = Path(__file__).parent.parent
 MODEL_DIR = BASE_DIR / "models"
 DOCS_DIR = BASE_DIR / "rag_docs"  # Additional documentation folder
+CACHE_DIR = BASE_DIR / ".rag_cache"  # Persisted vector store (see init_vector_store)
 DEFAULT_MODEL = "mistral-7b-instruct-v0.2.Q4_K_M.gguf"
+EMBED_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+ONNX_DIR = MODEL_DIR / "minilm_onnx"  # int8 ONNX export of EMBED_MODEL
+N_CTX = 4096  # LLM context window (tokens)
+MAX_NEW_TOKENS = 512  # Answer length limit
+MAX_QUERY_TOKENS = 512  # Longer /chat messages are rejected with 413
+CTX_MARGIN = 128  # Headroom kept free when fitting retrieved context into N_CTX
+# On-disk dtype of the cached corpus matrix; cosine ranking is robust to fp16
+# rounding. In memory it is float32: numpy has no float16 BLAS path, so an
+# fp16 matmul would upcast the whole matrix and run a scalar loop per query.
+DISK_DTYPE = np.float16
+RETRIEVE_CACHE_SIZE = 256  # Memoized (query, top_k) -> retrieved chunks
+RESPONSE_CACHE_SIZE = 512  # Memoized (query, retrieved chunks) -> LLM answer
+VECTOR_STORE_VERSION = 2  # Bump when chunking/filtering in init_vector_store changes
+ENCODE_BLOCK = 64  # Chunks embedded per encode() call when building the vector store
 
 # Knowledge base - platform-specific information
 KNOWLEDGE_BASE = [
@@ -157,10 +268,22 @@ relevant information, say so honestly and provide general DeFi guidance.
 Keep answers concise, friendly, and actionable. Use bullet points and numbered steps when appropriate.
 If users ask about specific transactions, remind them to always verify details in their wallet before confirming."""
 
+# Prompt template (Mistral Instruct format), split around the per-request parts:
+#   PROMPT_PREFIX + context + PROMPT_MID + query + PROMPT_SUFFIX
+# The prefix is identical for every request, which is what lets llama.cpp
+# reuse its KV entries instead of re-prefilling it (see init_llm). No literal "<s>": llama-cpp-python
+# already prepends BOS, and special-token parsing would make it a second one.
+PROMPT_PREFIX = f"[INST] {SYSTEM_PROMPT}\n\nContext from knowledge base:\n"
+PROMPT_MID = "\n\nUser question: "
+PROMPT_SUFFIX = " [/INST]"
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+
 # ============================================================================
 # RAG Components
 # ============================================================================
 
+MD_SECTION_RE = re.compile(r"^## (.+)$", re.MULTILINE)
+
 def load_markdown_docs():
     """Load markdown documentation files from rag_docs folder."""
     docs = []
@@ -168,29 +291,15 @@ def load_markdown_docs():
         for md_file in sorted(DOCS_DIR.glob("*.md")):
             try:
                 content = md_file.read_text(encoding='utf-8')
-                # Split by headings for smaller chunks
-                sections = []
-                current_title = md_file.stem
-                current_content = []
-                
-                for line in content.split('\n'):
-                    if line.startswith('## '):
-                        if current_content:
-                            sections.append({
-                                "title": current_title,
-                                "content": '\n'.join(current_content)
-                            })
-                        current_title = line[3:].strip()
-                        current_content = []
-                    else:
-                        current_content.append(line)
-                
-                # Add last section
-                if current_content:
-                    sections.append({
-                        "title": current_title,
-                        "content": '\n'.join(current_content)
-                    })
+                # Split by "## " headings for smaller chunks: the result
+                # alternates [preamble, title1, body1, title2, body2, ...]
+                parts = MD_SECTION_RE.split(content)
+                titles = [md_file.stem] + [t.strip() for t in parts[1::2]]
+                sections = [
+                    {"title": title, "content": body}
+                    for title, body in zip(titles, parts[0::2])
+                    if body.strip()
+                ]
                 
                 docs.extend(sections)
                 print(f"[RAG] Loaded {len(sections)} sections from {md_file.name}")
@@ -198,23 +307,151 @@ def load_markdown_docs():
                 print(f"[RAG] Warning: Failed to load {md_file}: {e}")
     return docs
 
+class OnnxEmbedder:
+    """int8-quantized MiniLM on ONNX Runtime with a SentenceTransformer-style encode()."""
+    
+    MAX_LENGTH = 256  # all-MiniLM-L6-v2 max_seq_length
+    
+    def __init__(self, model_dir: Path):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+        
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = args.embed_threads
+        opts.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(
+            str(model_dir / "model_int8.onnx"),
+            sess_options=opts,
+            providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(str(model_dir))
+    
+    @staticmethod
+    def export(model_dir: Path):
+        """One-time ONNX export + dynamic int8 quantization of EMBED_MODEL."""
+        from optimum.exporters.onnx import main_export
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        
+        print(f"[RAG] Exporting {EMBED_MODEL} to ONNX (one-time)...")
+        main_export(EMBED_MODEL, output=str(model_dir), task="feature-extraction")
+        quantize_dynamic(
+            str(model_dir / "model.onnx"),
+            str(model_dir / "model_int8.onnx"),
+            weight_type=QuantType.QInt8
+        )
+    
+    def encode(self, sentences, batch_size: int = 32, convert_to_numpy: bool = True,
+               show_progress_bar: bool = False) -> np.ndarray:
+        """Mean-pooled, L2-normalized sentence embeddings (float32)."""
+        out = []
+        for i in range(0, len(sentences), batch_size):
+            batch = self.tokenizer(
+                list(sentences[i:i + batch_size]),
+                padding=True,
+                truncation=True,
+                max_length=self.MAX_LENGTH,
+                return_tensors="np"
+            )
+            feeds = {k: v.astype(np.int64) for k, v in batch.items() if k in self.input_names}
+            hidden = self.session.run(None, feeds)[0]
+            mask = batch["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            out.append(pooled.astype(np.float32))
+        if not out:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.concatenate(out, axis=0)
+
+def resolve_embed_device() -> str:
+    """Pick the embedding device for --embed-device (auto: CUDA, then MPS, then CPU)."""
+    if args.embed_device != "auto":
+        return args.embed_device
+    try:
+        import torch
+    except ImportError:
+        return "cpu"
+    if torch.cuda.is_available():
+        return "cuda"
+    mps = getattr(torch.backends, "mps", None)
+    if mps is not None and mps.is_available():
+        return "mps"
+    return "cpu"
+
+@functools.lru_cache(maxsize=None)
+def embed_backend() -> str:
+    """Which embedder init_embedding_model() will build; decided without loading it."""
+    device = resolve_embed_device()
+    if device != "cpu":
+        return f"sentence-transformers-{device}"
+    needed = ["onnxruntime", "transformers"]
+    if not (ONNX_DIR / "model_int8.onnx").exists():
+        needed.append("optimum")  # One-time export
+    if all(importlib.util.find_spec(m) is not None for m in needed):
+        return "onnx-int8"
+    return "sentence-transformers-cpu"
+
 def init_embedding_model():
-    """Initialize the sentence transformer embedding model."""
+    """Initialize the embedding model (sentence-transformers on GPU, int8 ONNX on CPU)."""
     global embed_model
     if embed_model is None:
-        from sentence_transformers import SentenceTransformer
-        print("[RAG] Loading embedding model (all-MiniLM-L6-v2)...")
-        embed_model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+        backend = embed_backend()
+        print(f"[RAG] Loading embedding model ({EMBED_MODEL.split('/')[-1]}, {backend})...")
+        if backend == "onnx-int8":
+            if not (ONNX_DIR / "model_int8.onnx").exists():
+                OnnxEmbedder.export(ONNX_DIR)
+            embed_model = OnnxEmbedder(ONNX_DIR)
+        else:
+            # On a GPU, even a small one runs MiniLM far faster than the CPU and
+            # leaves every core to llama.cpp. On CPU this is the fallback when
+            # ONNX Runtime/optimum are not installed.
+            from sentence_transformers import SentenceTransformer
+            device = resolve_embed_device()
+            if device == "cpu":
+                import torch
+                torch.set_num_threads(args.embed_threads)
+            embed_model = SentenceTransformer(EMBED_MODEL, device=device)
         print("[RAG] Embedding model loaded.")
     return embed_model
 
+def vector_store_cache_key() -> str:
+    """Hash of everything the vector store is built from (corpus, chunking, embedder)."""
+    h = hashlib.sha256()
+    h.update(f"v{VECTOR_STORE_VERSION}\0{EMBED_MODEL}\0{embed_backend()}\0".encode())
+    h.update(json.dumps(KNOWLEDGE_BASE, sort_keys=True).encode())
+    if DOCS_DIR.exists():
+        for md_file in sorted(DOCS_DIR.glob("*.md")):
+            h.update(md_file.name.encode())
+            h.update(md_file.read_bytes())
+    return h.hexdigest()[:16]
+
+def normalize_rows(x: np.ndarray) -> np.ndarray:
+    """L2-normalize each row of a 2-D float32 array."""
+    x = np.ascontiguousarray(x, dtype=np.float32)
+    return x / np.clip(np.linalg.norm(x, axis=1, keepdims=True), 1e-12, None)
+
 def init_vector_store():
-    """Build FAISS index from knowledge base."""
-    global index, chunks, chunk_metadata
-    if index is not None:
-        return index
+    """Build the embedding matrix from knowledge base (or load it from the on-disk cache)."""
+    global embedding_matrix, chunks, chunk_metadata
+    if embedding_matrix is not None:
+        return embedding_matrix
     
-    import faiss
+    # The corpus is static between runs, so reuse the matrix from a previous
+    # start when nothing has changed. The embedding model is then only loaded
+    # on the first query.
+    key = vector_store_cache_key()
+    matrix_path = CACHE_DIR / f"{key}.npy"
+    chunks_path = CACHE_DIR / f"{key}.pkl"
+    if matrix_path.exists() and chunks_path.exists():
+        try:
+            matrix = np.load(matrix_path).astype(np.float32)  # upcast once, not per query
+            with open(chunks_path, "rb") as f:
+                chunks, chunk_metadata = pickle.load(f)
+            embedding_matrix = matrix
+            print(f"[RAG] Loaded cached vector store ({len(chunks)} chunks) from {matrix_path.name}")
+            return embedding_matrix
+        except Exception as e:
+            print(f"[RAG] Warning: Failed to load cached vector store: {e}")
     
     print("[RAG] Building vector store from knowledge base...")
     model = init_embedding_model()
@@ -236,51 +473,273 @@ def init_vector_store():
     
     print(f"[RAG] Total chunks: {len(chunks)} (builtin: {len(KNOWLEDGE_BASE)}, docs: {len(md_docs)})")
     
-    # Embed all chunks
-    embeddings = model.encode(chunks, convert_to_numpy=True, show_progress_bar=True)
+    # A few hundred chunks is far too small for an ANN index to pay off: keep a
+    # normalized float32 matrix and score with one BLAS matmul (cosine
+    # similarity); only the on-disk cache is stored as DISK_DTYPE.
+    # Chunks are embedded block by block straight into a preallocated matrix,
+    # so peak RAM stays at one extra block regardless of corpus size.
+    # Each block is a single forward pass, and no progress bar is drawn.
+    print(f"[RAG] Encoding {len(chunks)} chunks...")
+    t0 = time.perf_counter()
+    matrix = None
+    for i in range(0, len(chunks), ENCODE_BLOCK):
+        block = model.encode(chunks[i:i + ENCODE_BLOCK], convert_to_numpy=True,
+                             batch_size=min(ENCODE_BLOCK, len(chunks)), show_progress_bar=False)
+        if matrix is None:
+            matrix = np.empty((len(chunks), block.shape[1]), dtype=np.float32)
+        matrix[i:i + len(block)] = normalize_rows(block)
+        del block
+    embedding_matrix = matrix
     
-    # Build FAISS index
-    d = embeddings.shape[1]
-    index = faiss.IndexFlatIP(d)  # Inner product (cosine similarity with normalized vectors)
-    faiss.normalize_L2(embeddings)
-    index.add(embeddings)
+    print(f"[RAG] Vector store built with {len(chunks)} chunks in {time.perf_counter() - t0:.2f}s.")
+    
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        np.save(matrix_path, embedding_matrix.astype(DISK_DTYPE))
+        with open(chunks_path, "wb") as f:
+            pickle.dump((chunks, chunk_metadata), f)
+        print(f"[RAG] Cached vector store to {matrix_path.parent}")
+    except Exception as e:
+        print(f"[RAG] Warning: Failed to cache vector store: {e}")
     
-    print(f"[RAG] Vector store built with {len(chunks)} chunks.")
-    return index
+    return embedding_matrix
 
-def retrieve(query: str, top_k: int = 3) -> list:
-    """Retrieve top-k relevant chunks for a query."""
-    global index, chunks
+def select_top_k(scores: np.ndarray, k: int):
+    """Best k entries per row of a (B, N) (or (N,)) score array, sorted descending.
     
-    if index is None:
-        init_vector_store()
+    argpartition selects the k survivors in O(N); only those k are then sorted,
+    instead of argsort's O(N log N) over every row.
+    Returns (scores, indices), each (B, min(k, N)).
+    """
+    scores = np.atleast_2d(scores)
+    n = scores.shape[1]
+    k = max(0, min(k, n))
+    if k == 0:
+        return np.empty((len(scores), 0), dtype=scores.dtype), np.empty((len(scores), 0), dtype=np.intp)
     
-    model = init_embedding_model()
-    query_embedding = model.encode([query], convert_to_numpy=True)
+    if k < n:
+        idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.broadcast_to(np.arange(n), scores.shape)
+    top = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-top, axis=1)
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(idx, order, axis=1)
+
+if njit is not None:
+    # fastmath without the no-NaN/no-Inf assumptions: selection compares against -inf.
+    # Deliberately serial: at N~hundreds a thread-pool launch costs more than
+    # the work, and it would compete with llama.cpp for the pinned cores.
+    @njit(cache=True, fastmath={"nsz", "arcp", "contract", "afn", "reassoc"})
+    def search_kernel(M, Q, out_scores, out_idx):
+        """Fused normalize + M @ q + top-k for each row of Q, written into out_* (B, k)."""
+        n, d = M.shape
+        b, k = out_idx.shape
+        scores = np.empty((b, n), dtype=np.float32)
+        for r in range(b):
+            qn = np.float32(0.0)
+            for j in range(d):
+                qn += Q[r, j] * Q[r, j]
+            inv = np.float32(1.0) / max(np.sqrt(qn), np.float32(1e-12))
+            for i in range(n):
+                s = np.float32(0.0)
+                for j in range(d):
+                    s += M[i, j] * Q[r, j]
+                scores[r, i] = s * inv
+        
+        # Insertion into a sorted k-buffer: O(N * k), and k is tiny
+        for r in range(b):
+            for t in range(k):
+                out_scores[r, t] = -np.inf
+                out_idx[r, t] = -1
+            for i in range(n):
+                s = scores[r, i]
+                if s > out_scores[r, k - 1]:
+                    pos = k - 1
+                    while pos > 0 and out_scores[r, pos - 1] < s:
+                        out_scores[r, pos] = out_scores[r, pos - 1]
+                        out_idx[r, pos] = out_idx[r, pos - 1]
+                        pos -= 1
+                    out_scores[r, pos] = s
+                    out_idx[r, pos] = i
+else:
+    search_kernel = None
+
+def search(query_embeddings: np.ndarray, k: int):
+    """Top-k cosine search of (B, d) query embeddings; returns (scores, indices), each (B, k)."""
+    global search_kernel
+    if search_kernel is not None:
+        queries = np.ascontiguousarray(query_embeddings, dtype=np.float32)
+        kk = max(0, min(k, embedding_matrix.shape[0]))
+        out_scores = np.empty((len(queries), kk), dtype=np.float32)
+        out_idx = np.empty((len(queries), kk), dtype=np.int64)
+        try:
+            if kk > 0:
+                # First call JIT-compiles (or loads from the on-disk cache); the
+                # startup warmup's retrieve() takes that hit.
+                search_kernel(embedding_matrix, queries, out_scores, out_idx)
+            return out_scores, out_idx
+        except Exception as e:
+            print(f"[RAG] Warning: numba search kernel failed ({e}); falling back to numpy search.")
+            search_kernel = None
+    
+    queries = normalize_rows(query_embeddings)
+    scores = queries @ embedding_matrix.T  # (B, N) float32 sgemm
+    return select_top_k(scores, k)
+
+class QueryBatcher:
+    """Micro-batches concurrent queries into one encode() + one search() matmul.
     
-    import faiss
-    faiss.normalize_L2(query_embedding)
+    Callers block in submit(); a background worker collects whatever is queued
+    within max_wait seconds (up to max_batch items) and serves them together.
+    """
     
-    scores, indices = index.search(query_embedding, top_k)
+    def __init__(self, max_batch: int = 32, max_wait: float = 0.010):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._run, name="QueryBatcher", daemon=True)
+        self.worker.start()
     
-    results = []
-    for i, idx in enumerate(indices[0]):
-        if idx < len(chunks):
-            results.append({
-                "content": chunks[idx],
-                "score": float(scores[0][i]),
-                "metadata": chunk_metadata[idx]
-            })
+    def submit(self, query: str, top_k: int):
+        """Return (scores, indices) for a single query, shape (top_k,) each."""
+        # Validated here, before queueing: a bad value inside a shared batch
+        # would fail every request batched with it.
+        if isinstance(top_k, bool) or not isinstance(top_k, int) or top_k < 1:
+            raise ValueError(f"top_k must be a positive integer, got {top_k!r}")
+        slot = {"query": query, "top_k": top_k, "event": threading.Event(),
+                "result": None, "error": None}
+        self.queue.put(slot)
+        slot["event"].wait()
+        if slot["error"] is not None:
+            raise slot["error"]
+        return slot["result"]
     
-    return results
+    def _collect(self) -> list:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+    
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                if embedding_matrix is None:
+                    init_vector_store()
+                model = init_embedding_model()
+                
+                embeddings = model.encode([s["query"] for s in batch], convert_to_numpy=True,
+                                          batch_size=self.max_batch)
+                k = max(s["top_k"] for s in batch)
+                scores, indices = search(embeddings, k)
+                for row, s in enumerate(batch):
+                    s["result"] = (scores[row, :s["top_k"]], indices[row, :s["top_k"]])
+            except Exception as e:
+                for s in batch:
+                    s["error"] = e
+            finally:
+                for s in batch:
+                    s["event"].set()
+
+def get_query_batcher() -> QueryBatcher:
+    """Start the query batcher worker on first use."""
+    global query_batcher
+    with batcher_lock:
+        if query_batcher is None:
+            query_batcher = QueryBatcher()
+    return query_batcher
+
+@dataclass(frozen=True)
+class Hit:
+    """One retrieved chunk. Immutable, since retrieve() results are shared via its cache."""
+    # Declared by hand: dataclass(slots=True) needs Python 3.10+
+    __slots__ = ("id", "content", "score", "title", "source")
+    
+    id: int
+    content: str
+    score: float
+    title: str
+    source: str
+    
+    def to_dict(self) -> dict:
+        """JSON shape returned by /retrieve."""
+        return {
+            "id": self.id,
+            "content": self.content,
+            "score": self.score,
+            "metadata": {"title": self.title, "source": self.source}
+        }
+
+def retrieve_uncached(query: str, top_k: int = 3) -> tuple:
+    """Retrieve top-k relevant chunks for a query."""
+    scores, indices = get_query_batcher().submit(query, top_k)
+    n = len(chunks)
+    return tuple(
+        Hit(int(idx), chunks[idx], float(score), chunk_metadata[idx]["title"], chunk_metadata[idx]["source"])
+        for score, idx in zip(scores.tolist(), indices.tolist())
+        if 0 <= idx < n
+    )
+
+retrieve_cached = functools.lru_cache(maxsize=RETRIEVE_CACHE_SIZE)(retrieve_uncached)
+
+def retrieve(query: str, top_k: int = 3) -> tuple:
+    """Retrieve top-k relevant chunks for a query (memoized unless --no-cache).
+    
+    Results are shared between callers and must not be mutated.
+    """
+    if args.no_cache:
+        return retrieve_uncached(query, top_k)
+    return retrieve_cached(query, top_k)
+
+class LRUCache:
+    """Thread-safe LRU mapping with a fixed capacity."""
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        with self.lock:
+            if key not in self.data:
+                return None
+            self.data.move_to_end(key)
+            return self.data[key]
+    
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+    
+    def clear(self) -> int:
+        with self.lock:
+            n = len(self.data)
+            self.data.clear()
+            return n
+
+response_cache = LRUCache(RESPONSE_CACHE_SIZE)
+
+def response_cache_key(query: str, context_chunks) -> str:
+    """Key an answer by everything that goes into its prompt."""
+    ids = ",".join(str(c.id) for c in sorted(context_chunks, key=lambda c: c.id))
+    return hashlib.sha1(f"{PROMPT_PREFIX}\0{query}\0{ids}".encode()).hexdigest()
 
 def init_llm(model_path: str = None):
-    """Initialize the local LLM using ctransformers."""
-    global llm
+    """Initialize the local LLM using llama-cpp-python."""
+    global llm, prompt_prefix_tokens
     if llm is not None:
         return llm
     
-    from ctransformers import AutoModelForCausalLM
+    from llama_cpp import Llama, LlamaRAMCache
     
     # Find model file
     if model_path is None:
@@ -296,47 +755,110 @@ def init_llm(model_path: str = None):
     print(f"[RAG] Loading LLM from {model_path}...")
     print(f"[RAG] Using {args.threads} CPU threads")
     
-    # Use ctransformers with GGUF model
-    llm = AutoModelForCausalLM.from_pretrained(
-        str(model_path.parent),
-        model_file=model_path.name,
-        model_type="mistral",
-        threads=args.threads,
-        context_length=4096,
-        gpu_layers=0  # CPU only
+    # Q4_K_M GGUF via llama.cpp: mmap the weights (fast warm loads, shared page
+    # cache) and prefill in large batches so prompt processing is not stalled.
+    llm = Llama(
+        model_path=str(model_path),
+        n_ctx=N_CTX,
+        n_threads=args.threads,
+        n_threads_batch=args.threads,
+        n_batch=2048,
+        n_ubatch=512,
+        n_gpu_layers=0,  # CPU only
+        use_mmap=True,
+        use_mlock=False,
+        verbose=False
     )
     
-    print("[RAG] LLM loaded successfully!")
+    # llama.cpp already reuses the longest prefix shared with the previous
+    # prompt still in its context (the system prompt). A RAM cache of saved
+    # states additionally survives alternating contexts, but every completion
+    # then copies the KV cache plus logits (hundreds of MB), so it is opt-in.
+    if args.prompt_cache_mb > 0 and not args.no_cache:
+        llm.set_cache(LlamaRAMCache(capacity_bytes=args.prompt_cache_mb << 20))
+        print(f"[RAG] Prompt state cache: {args.prompt_cache_mb} MB")
+    prompt_prefix_tokens = llm.tokenize(PROMPT_PREFIX.encode("utf-8"), special=True)
+    
+    print(f"[RAG] LLM loaded successfully! (prompt prefix: {len(prompt_prefix_tokens)} tokens)")
     return llm
 
-def generate_response(query: str, context_chunks: list) -> str:
-    """Generate a response using the local LLM with retrieved context."""
-    global llm
-    
+def build_prompt(query: str, context_chunks) -> str:
+    """Fill the prompt template with the retrieved context and the user question."""
+    # Chunks are ordered by id rather than score so the same retrieved set
+    # always yields a byte-identical prompt prefix.
+    context = CONTEXT_SEPARATOR.join([c.content for c in sorted(context_chunks, key=lambda c: c.id)])
+    return PROMPT_PREFIX + context + PROMPT_MID + query + PROMPT_SUFFIX
+
+def count_tokens(text: str) -> int:
+    """Number of LLM tokens in text (tokenizing only reads the vocab, no lock needed)."""
     if llm is None:
-        init_llm(args.model)
-    
-    # Build context string
-    context = "\n\n---\n\n".join([c["content"] for c in context_chunks])
+        with llm_lock:
+            init_llm(args.model)
+    return len(llm.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+
+def fit_context(query: str, context_chunks) -> list:
+    """Drop the lowest-scoring chunks until prompt + answer fit in the context window."""
+    budget = N_CTX - CTX_MARGIN - MAX_NEW_TOKENS
+    kept = list(context_chunks)  # retrieve() returns best-first
+    while kept:
+        n_prompt = count_tokens(build_prompt(query, kept))
+        if n_prompt <= budget:
+            break
+        dropped = kept.pop()
+        print(f"[RAG] Prompt is {n_prompt} tokens (budget {budget}); dropped context '{dropped.title}'")
+    return kept
+
+def stream_response(query: str, context_chunks: list):
+    """Yield the LLM's answer piece by piece as it is generated."""
+    prompt = build_prompt(query, context_chunks)
     
-    # Build prompt (Mistral Instruct format)
-    prompt = f"""<s>[INST] {SYSTEM_PROMPT}
+    # Generate response using llama-cpp-python. The lock is held until the
+    # stream is exhausted (or closed by a disconnecting client).
+    with llm_lock:
+        if llm is None:
+            init_llm(args.model)
+        
+        started = False
+        for chunk in llm(
+            prompt,
+            max_tokens=MAX_NEW_TOKENS,
+            temperature=0.7,
+            top_p=0.9,
+            stop=["</s>", "[INST]"],
+            stream=True
+        ):
+            text = chunk["choices"][0]["text"]
+            if not started:
+                text = text.lstrip()
+                started = bool(text)
+            if text:
+                yield text
 
-Context from knowledge base:
-{context}
+def generate_response(query: str, context_chunks: list) -> str:
+    """Generate a response using the local LLM with retrieved context."""
+    return "".join(stream_response(query, context_chunks)).strip()
 
-User question: {query} [/INST]"""
+def warmup():
+    """Run one dummy pass through each stage so the first real request is not a cold start."""
+    def stage(name, fn):
+        t0 = time.perf_counter()
+        try:
+            fn()
+            print(f"[RAG] Warmup {name}: {time.perf_counter() - t0:.2f}s")
+        except Exception as e:
+            print(f"[RAG] Warning: Warmup {name} failed: {e}")
     
-    # Generate response using ctransformers
-    response = llm(
-        prompt,
-        max_new_tokens=512,
-        temperature=0.7,
-        top_p=0.9,
-        stop=["</s>", "[INST]"]
-    )
+    print("[RAG] Warming up...")
+    stage("embedding", lambda: init_embedding_model().encode(["warmup"], convert_to_numpy=True))
+    stage("retrieve", lambda: retrieve("warmup query", top_k=3))
     
-    return response.strip()
+    # Prefilling the prompt prefix also leaves the tokens every /chat request
+    # shares in the KV cache, so the first request reuses them.
+    def warm_llm():
+        with llm_lock:
+            llm(prompt_prefix_tokens, max_tokens=8)
+    stage("llm", warm_llm)
+    print("[RAG] Warmup complete.")
 
 # ============================================================================
 # Flask API
@@ -360,21 +882,76 @@ def chat():
         return jsonify({"error": "No message provided"}), 400
     
     try:
-        # Retrieve relevant context
-        context_chunks = retrieve(query, top_k=3)
+        # One oversized paste would otherwise hold the single LLM for the
+        # whole prefill while everyone else waits.
+        n_query_tokens = count_tokens(query)
+        if n_query_tokens > MAX_QUERY_TOKENS:
+            return jsonify({"error": f"Message too long ({n_query_tokens} tokens, max {MAX_QUERY_TOKENS})"}), 413
+        
+        # Retrieve relevant context (trimmed to the context window)
+        context_chunks = fit_context(query, retrieve(query, top_k=3))
         
-        # Generate response
-        response = generate_response(query, context_chunks)
+        # Generate response (or reuse one for the same question and context)
+        key = response_cache_key(query, context_chunks)
+        response = None if args.no_cache else response_cache.get(key)
+        if response is None:
+            response = generate_response(query, context_chunks)
+            if not args.no_cache:
+                response_cache.put(key, response)
         
         return jsonify({
             "response": response,
-            "sources": [c["metadata"]["title"] for c in context_chunks]
+            "sources": [c.title for c in context_chunks]
         })
     
     except Exception as e:
         print(f"[RAG] Error: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    """Streaming chat endpoint - same as /chat, but sends tokens as Server-Sent Events."""
+    data = request.get_json()
+    query = data.get("message", "").strip()
+    
+    if not query:
+        return jsonify({"error": "No message provided"}), 400
+    
+    try:
+        n_query_tokens = count_tokens(query)
+    except Exception as e:
+        print(f"[RAG] Error: {e}")
+        return jsonify({"error": str(e)}), 500
+    if n_query_tokens > MAX_QUERY_TOKENS:
+        return jsonify({"error": f"Message too long ({n_query_tokens} tokens, max {MAX_QUERY_TOKENS})"}), 413
+    
+    def sse(payload: dict) -> str:
+        return f"data: {json.dumps(payload)}\n\n"
+    
+    def gen():
+        try:
+            context_chunks = fit_context(query, retrieve(query, top_k=3))
+            yield sse({"sources": [c.title for c in context_chunks]})
+            
+            key = response_cache_key(query, context_chunks)
+            cached = None if args.no_cache else response_cache.get(key)
+            if cached is not None:
+                yield sse({"token": cached})
+            else:
+                tokens = []
+                for token in stream_response(query, context_chunks):
+                    tokens.append(token)
+                    yield sse({"token": token})
+                if not args.no_cache:
+                    response_cache.put(key, "".join(tokens).strip())
+        except Exception as e:
+            print(f"[RAG] Error: {e}")
+            yield sse({"error": str(e)})
+        yield "data: [DONE]\n\n"
+    
+    return Response(stream_with_context(gen()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.route("/retrieve", methods=["POST"])
 def retrieve_only():
     """Retrieve relevant chunks without generating a response."""
@@ -384,13 +961,35 @@ def retrieve_only():
     
     if not query:
         return jsonify({"error": "No query provided"}), 400
+    if isinstance(top_k, bool) or not isinstance(top_k, int) or top_k < 1:
+        return jsonify({"error": "top_k must be a positive integer"}), 400
     
     try:
         results = retrieve(query, top_k=top_k)
-        return jsonify({"results": results})
+        return jsonify({"results": [hit.to_dict() for hit in results]})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/cache/clear", methods=["POST"])
+def cache_clear():
+    """Admin: drop all memoized retrievals and responses.
+    
+    Requires the X-Admin-Token header to match --admin-token (or RAG_ADMIN_TOKEN);
+    disabled when no token is configured. The server listens on 0.0.0.0 with
+    CORS open to every origin, so an unauthenticated endpoint could be hit by
+    any web page. This does not rebuild the vector store: knowledge base edits
+    need a restart.
+    """
+    token = args.admin_token or os.environ.get("RAG_ADMIN_TOKEN")
+    if not token:
+        return jsonify({"error": "Cache admin is disabled (start with --admin-token)"}), 403
+    if not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), token):
+        return jsonify({"error": "Invalid admin token"}), 403
+    
+    retrieve_cached.cache_clear()
+    cleared = response_cache.clear()
+    return jsonify({"status": "ok", "responses_cleared": cleared})
+
 # ============================================================================
 # Main
 # ============================================================================
@@ -403,25 +1002,35 @@ if __name__ == "__main__":
     print("=" * 60)
     print(f"Port: {args.port}")
     print(f"Threads: {args.threads}")
+    print(f"Embedding device: {args.embed_device}")
     print(f"Model: {args.model or (MODEL_DIR / DEFAULT_MODEL)}")
     print("=" * 60)
     
     try:
         # Pre-initialize components
         print("\n[RAG] Initializing components...")
-        init_embedding_model()
         init_vector_store()
         init_llm(args.model)
+        warmup()
         
         print(f"\n[RAG] Server starting on http://localhost:{args.port}")
         print("[RAG] Endpoints:")
         print(f"  POST /chat     - Send message, get AI response")
+        print(f"  POST /chat/stream - Same as /chat, streamed as Server-Sent Events")
         print(f"  POST /retrieve - Get relevant context chunks")
+        print(f"  POST /cache/clear - Clear retrieval/response caches (needs --admin-token)")
         print(f"  GET  /health   - Health check")
         print("\n" + "=" * 60)
         
-        # Use threaded=False to avoid potential multiprocessing issues
-        app.run(host="0.0.0.0", port=args.port, debug=False, threaded=False, use_reloader=False)
+        # Multi-threaded WSGI server: /health and /retrieve stay responsive (and
+        # get micro-batched) while a /chat holds the LLM lock; queued chats run
+        # in arrival order.
+        try:
+            from waitress import serve
+            serve(app, host="0.0.0.0", port=args.port, threads=8)
+        except ImportError:
+            print("[RAG] Warning: waitress not installed; falling back to the Flask development server.")
+            app.run(host="0.0.0.0", port=args.port, debug=False, threaded=True, use_reloader=False)
     
     except KeyboardInterrupt:
         print("\n[RAG] Server stopped by user.")